@@ -1,12 +1,24 @@
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr, Field
-from passlib.context import CryptContext
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from database import vendors_collection
-from datetime import datetime, timedelta
+from datetime import timedelta
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 from typing import Optional
+from utils import utc_now
+from cachetools import TTLCache
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import base64
+import bcrypt
+import hashlib
+import multiprocessing
+import time
 import jwt
 import os
 
@@ -17,12 +29,33 @@ router = APIRouter()
 
 security = HTTPBearer()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2 for new hashes; bcrypt kept so existing vendor passwords still verify
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Hash/verify in worker processes when enabled, otherwise in the default thread pool
+PASSWORD_PROCESS_POOL = os.getenv("PASSWORD_PROCESS_POOL", "false").lower() == "true"
+_password_pool = None
 
 JWT_SECRET = os.getenv("JWT_SECRET", "mysecretkey123")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM","HS256")
 JWT_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES",60))
 
+# HMAC key built once; jwt.decode uses a PyJWK's key as-is instead of re-preparing it per call
+_jwt_key = jwt.PyJWK(
+    {"kty": "oct", "k": base64.urlsafe_b64encode(JWT_SECRET.encode()).rstrip(b"=").decode()},
+    JWT_ALGORITHM
+)
+
+# Both caches are keyed by SHA-256 of the token, so raw tokens are never stored.
+# Authenticated vendors, stored as (expires_at, vendor), are refreshed from the DB every minute
+AUTH_CACHE_TTL = 60
+_auth_cache = TTLCache(maxsize=10_000, ttl=AUTH_CACHE_TTL)
+_vendor_cache_keys = {}  # vendor_id -> set of _auth_cache keys
+_vendor_invalidations = {}  # vendor_id -> invalidation count, so a read that raced one is not cached
+
+# Decoded JWT payloads live for the token's lifetime, so a vendor refresh skips the decode
+_jwt_cache = TTLCache(maxsize=10_000, ttl=JWT_EXPIRE_MINUTES * 60)
+
 
 # Vendor registration request model
 class VendorRegisterRequest(BaseModel):
@@ -43,10 +76,83 @@ class VendorUpdateRequest(BaseModel):
     business_name: Optional[str] = Field(None, example="John's Cafe")
 
 
-def get_current_vendor(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def start_password_pool():
+    global _password_pool
+    if PASSWORD_PROCESS_POOL and _password_pool is None:
+        # forkserver so workers are not forked from a process running Motor/PyMongo threads
+        _password_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+
+
+def stop_password_pool():
+    global _password_pool
+    if _password_pool is not None:
+        _password_pool.shutdown()
+        _password_pool = None
+
+
+def _hash_password(password: str) -> str:
+    return password_hasher.hash(password)
+
+
+def _verify_password(password: str, password_hash: str) -> bool:
+    if password_hash.startswith("$2"):
+        try:
+            return bcrypt.checkpw(password.encode(), password_hash.encode())
+        except ValueError:
+            return False
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def _cache_vendor(cache_key: bytes, expires_at: float, vendor: dict, read_invalidations: int):
+    # Skip if the vendor was invalidated while it was being read
+    if _vendor_invalidations.get(vendor["_id"], 0) != read_invalidations:
+        return
+
+    _auth_cache[cache_key] = (expires_at, vendor)
+
+    # Drop keys that already expired from _auth_cache while recording the new one
+    keys = {key for key in _vendor_cache_keys.get(vendor["_id"], ()) if key in _auth_cache}
+    keys.add(cache_key)
+    _vendor_cache_keys[vendor["_id"]] = keys
+
+
+def _invalidate_vendor_cache(vendor_id: ObjectId):
+    _vendor_invalidations[vendor_id] = _vendor_invalidations.get(vendor_id, 0) + 1
+    for key in _vendor_cache_keys.pop(vendor_id, ()):
+        _auth_cache.pop(key, None)
+
+
+def _decode_token(token: str, cache_key: bytes) -> dict:
+    payload = _jwt_cache.get(cache_key)
+    if payload is None:
+        payload = jwt.decode(token, _jwt_key, algorithms=[JWT_ALGORITHM], options={"require": ["exp"]})
+        _jwt_cache[cache_key] = payload
+    elif payload["exp"] <= time.time():
+        _jwt_cache.pop(cache_key, None)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
+
+async def get_current_vendor(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
+
+    # Serve repeat tokens from cache, never past the token's own expiry
+    cache_key = hashlib.sha256(token.encode()).digest()
+    cached = _auth_cache.get(cache_key)
+    if cached is not None:
+        expires_at, vendor = cached
+        if expires_at > time.time():
+            return vendor
+        _auth_cache.pop(cache_key, None)
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = _decode_token(token, cache_key)
         vendor_id = payload.get("vendor_id")
         if not vendor_id:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -56,53 +162,61 @@ def get_current_vendor(credentials: HTTPAuthorizationCredentials = Depends(secur
         raise HTTPException(status_code=401, detail="Invalid token")
 
     # Fetch vendor from DB
-    vendor = vendors_collection.find_one({"_id": ObjectId(vendor_id)})
+    vendor_obj_id = ObjectId(vendor_id)
+    read_invalidations = _vendor_invalidations.get(vendor_obj_id, 0)
+    vendor = await vendors_collection.find_one({"_id": vendor_obj_id}, projection={"password_hash": 0})
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
-    
+
+    expires_at = min(time.time() + AUTH_CACHE_TTL, payload["exp"])
+    _cache_vendor(cache_key, expires_at, vendor, read_invalidations)
+
     return vendor
 
 
 @router.post("/register")
 async def register_vendor(vendor: VendorRegisterRequest):
-    # Check if vendor already exists
-    if vendors_collection.find_one({"email": vendor.email}):
-        raise HTTPException(status_code=400, detail="Email already registered")
-
     # Hash password
-    hashed_password = pwd_context.hash(vendor.password)
+    loop = asyncio.get_running_loop()
+    hashed_password = await loop.run_in_executor(_password_pool, _hash_password, vendor.password)
 
     # Insert into database
+    now = utc_now()
     vendor_doc = {
         "name": vendor.name,
         "email": vendor.email,
         "password_hash": hashed_password,
         "business_name": vendor.business_name,
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
+        "created_at": now,
+        "updated_at": now
     }
 
-    result = vendors_collection.insert_one(vendor_doc)
-    vendor_id = str(result.inserted_id)
+    # Unique email index rejects existing vendors
+    try:
+        result = await vendors_collection.insert_one(vendor_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    vendor_id = result.inserted_id.binary.hex()
 
     return {"message": "Vendor registered successfully", "vendor_id": vendor_id}
 
 
 @router.post("/login")
 async def login_vendor(credentials: VendorLoginRequest):
-    vendor = vendors_collection.find_one({"email": credentials.email})
+    vendor = await vendors_collection.find_one({"email": credentials.email})
     if not vendor:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Verify password
-    if not pwd_context.verify(credentials.password, vendor["password_hash"]):
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(_password_pool, _verify_password, credentials.password, vendor["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Create JWT token
     payload = {
-        "vendor_id": str(vendor["_id"]),
+        "vendor_id": vendor["_id"].binary.hex(),
         "email": vendor["email"],
-        "exp": datetime.utcnow() + timedelta(minutes=JWT_EXPIRE_MINUTES)
+        "exp": utc_now() + timedelta(minutes=JWT_EXPIRE_MINUTES)
     }
     token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
     
@@ -113,7 +227,7 @@ async def login_vendor(credentials: VendorLoginRequest):
 async def get_vendor_profile(current_vendor: dict = Depends(get_current_vendor)):
     # Return selected fields only
     return {
-        "vendor_id": str(current_vendor["_id"]),
+        "vendor_id": current_vendor["_id"].binary.hex(),
         "name": current_vendor["name"],
         "email": current_vendor["email"],
         "business_name": current_vendor["business_name"],
@@ -129,17 +243,18 @@ async def update_vendor_profile(update_data: VendorUpdateRequest, current_vendor
     if not update_fields:
         return {"message": "No fields to update"}
     
-    update_fields["updated_at"] = datetime.utcnow()
+    update_fields["updated_at"] = utc_now()
     
-    vendors_collection.update_one(
+    vendor = await vendors_collection.find_one_and_update(
         {"_id": current_vendor["_id"]},
-        {"$set": update_fields}
+        {"$set": update_fields},
+        return_document=ReturnDocument.AFTER
     )
     
-    vendor = vendors_collection.find_one({"_id": current_vendor["_id"]})
+    _invalidate_vendor_cache(current_vendor["_id"])
     
     return {
-        "vendor_id": str(vendor["_id"]),
+        "vendor_id": vendor["_id"].binary.hex(),
         "name": vendor.get("name"),
         "email": vendor.get("email"),
         "business_name": vendor.get("business_name"),
@@ -1,16 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, Path
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from fastapi.responses import RedirectResponse
 from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
 from bson import ObjectId
+from botocore.exceptions import BotoCoreError, ClientError
+from pymongo import ReturnDocument
 from database import customers_collection
-import qrcode, os
+from storage import upload_qr, delete_qr, presign_qr, qr_url
+import asyncio
+import logging
+import os
 
 from auth import get_current_vendor
+from utils import render_qr, utc_now
 
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+LEGACY_QR_DIR = "qrcodes"  # QR codes were written here before moving to object storage
+
+BULK_REGISTER_LIMIT = 500
+BULK_QR_CONCURRENCY = 10  # Matches botocore's default connection pool size
+
 
 # Customer register request model
 class CustomerRegisterRequest(BaseModel):
@@ -37,42 +51,43 @@ class CustomerResponse(BaseModel):
     created_at: datetime
 
 
+async def _store_customer_qr(cust_obj_id: ObjectId, vendor_id: str) -> str:
+    # Generate QR code (content = customer_id + vendor_id)
+    customer_id = cust_obj_id.binary.hex()
+    qr_content = f"{customer_id}:{vendor_id}"
+    png_bytes = await asyncio.to_thread(render_qr, qr_content)
+
+    # Store QR code in object storage under the customer's ID
+    await upload_qr(customer_id, png_bytes)
+    return qr_url(customer_id)
+
+
 @router.post("/register", response_model=CustomerResponse)
 async def register_customer(customer: CustomerRegisterRequest, current_vendor: dict = Depends(get_current_vendor)):
+    vendor_id = current_vendor["_id"].binary.hex()
+
+    # Pre-generate the ID so the QR code is part of the initial insert
+    cust_obj_id = ObjectId()
+    qr_path = await _store_customer_qr(cust_obj_id, vendor_id)
+
     # Prepare customer document
     customer_doc = {
+        "_id": cust_obj_id,
         "vendor_id": current_vendor["_id"],   # FK reference to vendors
         "name": customer.name,
         "email": customer.email,
         "phone": customer.phone,
-        "qr_code": None,   # placeholder until we generate QR
-        "created_at": datetime.utcnow()
+        "qr_code": qr_path,
+        "created_at": utc_now()
     }
 
     # Insert into DB
-    result = customers_collection.insert_one(customer_doc)
-    customer_id = str(result.inserted_id)
-
-    # Generate QR code (content = customer_id + vendor_id)
-    qr_content = f"{customer_id}:{str(current_vendor['_id'])}"
-    qr = qrcode.make(qr_content)
-
-    # Save QR Code in local folder
-    qr_dir = "qrcodes"
-    os.makedirs(qr_dir, exist_ok=True)
-    qr_path = os.path.join(qr_dir, f"customer_{customer_id}.png")
-    qr.save(qr_path)
-
-    # Update customer with QR code path
-    customers_collection.update_one(
-        {"_id": ObjectId(customer_id)},
-        {"$set": {"qr_code": qr_path}}
-    )
+    await customers_collection.insert_one(customer_doc)
 
     # Return response
     return CustomerResponse(
-        customer_id=customer_id,
-        vendor_id=str(current_vendor["_id"]),
+        customer_id=cust_obj_id.binary.hex(),
+        vendor_id=vendor_id,
         name=customer.name,
         email=customer.email,
         phone=customer.phone,
@@ -81,17 +96,84 @@ async def register_customer(customer: CustomerRegisterRequest, current_vendor: d
     )
 
 
+@router.post("/bulk", response_model=List[CustomerResponse])
+async def register_customers_bulk(customers: List[CustomerRegisterRequest], current_vendor: dict = Depends(get_current_vendor)):
+    if not customers:
+        raise HTTPException(status_code=400, detail="No customers to register")
+
+    if len(customers) > BULK_REGISTER_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Cannot register more than {BULK_REGISTER_LIMIT} customers at once")
+
+    vendor_id = current_vendor["_id"].binary.hex()
+
+    # Pre-generate IDs and render/upload QR codes concurrently, a bounded number at a time
+    qr_slots = asyncio.Semaphore(BULK_QR_CONCURRENCY)
+
+    async def store_qr(cust_obj_id: ObjectId) -> str:
+        async with qr_slots:
+            return await _store_customer_qr(cust_obj_id, vendor_id)
+
+    cust_obj_ids = [ObjectId() for _ in customers]
+    qr_paths = await asyncio.gather(*[store_qr(cust_obj_id) for cust_obj_id in cust_obj_ids])
+
+    created_at = utc_now()
+    customer_docs = [
+        {
+            "_id": cust_obj_id,
+            "vendor_id": current_vendor["_id"],
+            "name": customer.name,
+            "email": customer.email,
+            "phone": customer.phone,
+            "qr_code": qr_path,
+            "created_at": created_at
+        }
+        for cust_obj_id, qr_path, customer in zip(cust_obj_ids, qr_paths, customers)
+    ]
+
+    # Insert all customers in one unordered batch
+    await customers_collection.insert_many(customer_docs, ordered=False)
+
+    return [
+        CustomerResponse(
+            customer_id=doc["_id"].binary.hex(),
+            vendor_id=vendor_id,
+            name=doc["name"],
+            email=doc["email"],
+            phone=doc["phone"],
+            qr_code=doc["qr_code"],
+            created_at=doc["created_at"]
+        )
+        for doc in customer_docs
+    ]
+
+
 @router.get("/all", response_model=List[CustomerResponse])
-async def list_customers(current_vendor: dict = Depends(get_current_vendor)):
-    # Fetch all customers for this vendor
-    customers_cursor = customers_collection.find({"vendor_id": current_vendor["_id"]})
+async def list_customers(
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of customers to return"),
+    after: Optional[str] = Query(None, description="Return customers after this customer_id"),
+    current_vendor: dict = Depends(get_current_vendor)
+):
+    query = {"vendor_id": current_vendor["_id"]}
+
+    # Keyset pagination on _id
+    if after:
+        if not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail="Invalid customer ID")
+        query["_id"] = {"$gt": ObjectId(after)}
+
+    # Fetch a page of customers for this vendor
+    customers_cursor = customers_collection.find(
+        query,
+        projection={"name": 1, "email": 1, "phone": 1, "qr_code": 1, "created_at": 1}
+    ).sort("_id", 1).limit(limit)
+    vendor_id = current_vendor["_id"].binary.hex()
     customers = []
 
-    for customer in customers_cursor:
+    for customer in await customers_cursor.to_list(length=limit):
         customers.append(
             CustomerResponse(
-                customer_id=str(customer["_id"]),
-                vendor_id=str(customer["vendor_id"]),
+                customer_id=customer["_id"].binary.hex(),
+                vendor_id=vendor_id,
                 name=customer.get("name"),
                 email=customer.get("email"),
                 phone=customer.get("phone"),
@@ -107,25 +189,23 @@ async def list_customers(current_vendor: dict = Depends(get_current_vendor)):
 @router.get("/{customer_id}", response_model=CustomerResponse)
 async def get_customer(customer_id: str = Path(..., description="ID of the customer"), current_vendor: dict = Depends(get_current_vendor)):
     # Convert string ID to ObjectId
-    try:
-        cust_obj_id = ObjectId(customer_id)
-    except:
+    if not ObjectId.is_valid(customer_id):
         raise HTTPException(status_code=400, detail="Invalid customer ID")
+    cust_obj_id = ObjectId(customer_id)
 
-    # Fetch customer from DB
-    customer = customers_collection.find_one({"_id": cust_obj_id})
+    # Fetch customer owned by this vendor
+    customer = await customers_collection.find_one({"_id": cust_obj_id, "vendor_id": current_vendor["_id"]})
 
     if not customer:
+        # Distinguish a missing customer from one owned by another vendor
+        if await customers_collection.count_documents({"_id": cust_obj_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Not authorized to access this customer")
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    # Check vendor ownership
-    if customer["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to access this customer")
-
     # Return customer response
     return CustomerResponse(
-        customer_id=str(customer["_id"]),
-        vendor_id=str(customer["vendor_id"]),
+        customer_id=customer["_id"].binary.hex(),
+        vendor_id=customer["vendor_id"].binary.hex(),
         name=customer.get("name"),
         email=customer.get("email"),
         phone=customer.get("phone"),
@@ -134,40 +214,57 @@ async def get_customer(customer_id: str = Path(..., description="ID of the custo
     )
 
 
-@router.put("/{customer_id}")
-async def update_customer(customer_id: str, updates: CustomerUpdateRequest, current_vendor: dict = Depends(get_current_vendor)):
+@router.get("/{customer_id}/qr")
+async def get_customer_qr(customer_id: str, current_vendor: dict = Depends(get_current_vendor)):
     # Convert ID
-    try:
-        cust_obj_id = ObjectId(customer_id)
-    except:
+    if not ObjectId.is_valid(customer_id):
         raise HTTPException(status_code=400, detail="Invalid customer ID")
+    cust_obj_id = ObjectId(customer_id)
 
-    # Find customer
-    customer = customers_collection.find_one({"_id": cust_obj_id})
+    # Find customer owned by this vendor
+    customer = await customers_collection.find_one(
+        {"_id": cust_obj_id, "vendor_id": current_vendor["_id"]},
+        projection={"_id": 1}
+    )
     if not customer:
+        if await customers_collection.count_documents({"_id": cust_obj_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Not authorized to access this customer")
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    # Vendor ownership check
-    if customer["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to update this customer")
+    # Redirect to a short-lived presigned URL for the stored QR code
+    qr_location = await presign_qr(cust_obj_id.binary.hex())
+    if not qr_location:
+        raise HTTPException(status_code=404, detail="QR code not found")
+
+    return RedirectResponse(qr_location)
+
+
+@router.put("/{customer_id}")
+async def update_customer(customer_id: str, updates: CustomerUpdateRequest, current_vendor: dict = Depends(get_current_vendor)):
+    # Convert ID
+    if not ObjectId.is_valid(customer_id):
+        raise HTTPException(status_code=400, detail="Invalid customer ID")
+    cust_obj_id = ObjectId(customer_id)
 
     update_fields = updates.dict(exclude_unset=True)
 
     if not update_fields:
         raise HTTPException(status_code=400, detail="No fields to update")
 
-    # Perform update
-    customers_collection.update_one(
-        {"_id": cust_obj_id},
-        {"$set": update_fields}
+    # Ownership check, update and fetch in a single query
+    updated_customer = await customers_collection.find_one_and_update(
+        {"_id": cust_obj_id, "vendor_id": current_vendor["_id"]},
+        {"$set": update_fields},
+        return_document=ReturnDocument.AFTER
     )
-
-    # Fetch updated customer
-    updated_customer = customers_collection.find_one({"_id": cust_obj_id})
+    if not updated_customer:
+        if await customers_collection.count_documents({"_id": cust_obj_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Not authorized to update this customer")
+        raise HTTPException(status_code=404, detail="Customer not found")
 
     return CustomerResponse(
-        customer_id=str(updated_customer["_id"]),
-        vendor_id=str(updated_customer["vendor_id"]),
+        customer_id=updated_customer["_id"].binary.hex(),
+        vendor_id=updated_customer["vendor_id"].binary.hex(),
         name=updated_customer.get("name"),
         email=updated_customer.get("email"),
         phone=updated_customer.get("phone"),
@@ -179,26 +276,29 @@ async def update_customer(customer_id: str, updates: CustomerUpdateRequest, curr
 @router.delete("/{customer_id}")
 async def delete_customer(customer_id: str, current_vendor: dict = Depends(get_current_vendor)):
     # Convert ID
-    try:
-        cust_obj_id = ObjectId(customer_id)
-    except:
+    if not ObjectId.is_valid(customer_id):
         raise HTTPException(status_code=400, detail="Invalid customer ID")
+    cust_obj_id = ObjectId(customer_id)
 
-    # Find customer
-    customer = customers_collection.find_one({"_id": cust_obj_id})
+    # Delete customer owned by this vendor
+    customer = await customers_collection.find_one_and_delete(
+        {"_id": cust_obj_id, "vendor_id": current_vendor["_id"]},
+        projection={"qr_code": 1}
+    )
     if not customer:
+        if await customers_collection.count_documents({"_id": cust_obj_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Not authorized to delete this customer")
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    # Vendor ownership check
-    if customer["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to delete this customer")
-
-    # Delete QR code file if exists
+    # Delete QR code file if exists; the customer is already gone, so failures are only logged
     qr_path = customer.get("qr_code")
-    if qr_path and os.path.exists(qr_path):
-        os.remove(qr_path)
-
-    # Delete customer from DB
-    customers_collection.delete_one({"_id": cust_obj_id})
+    if qr_path and qr_path.startswith(LEGACY_QR_DIR + os.sep):
+        if os.path.exists(qr_path):
+            os.remove(qr_path)
+    else:
+        try:
+            await delete_qr(cust_obj_id.binary.hex())
+        except (BotoCoreError, ClientError) as exc:
+            logger.warning("Failed to delete QR code for customer %s: %s", customer_id, exc)
 
     return {"message": f"Customer {customer_id} deleted successfully"}
\ No newline at end of file
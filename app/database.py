@@ -1,13 +1,21 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-client = MongoClient(MONGO_URI)
+client = AsyncIOMotorClient(MONGO_URI, tz_aware=True)  # Return timezone-aware UTC datetimes
 db = client.digital_loyalty_card  # Database will be created automatically
 
 vendors_collection = db.vendors 
 customers_collection = db.customers
-loyalty_cards_collection = db.loyalty_cards
\ No newline at end of file
+loyalty_cards_collection = db.loyalty_cards
+
+
+async def create_indexes():
+    # Indexes backing the lookups done by the auth, customer and loyalty card routes
+    await vendors_collection.create_index("email", unique=True)
+    await customers_collection.create_index([("vendor_id", 1), ("_id", 1)])
+    await loyalty_cards_collection.create_index([("vendor_id", 1), ("customer_id", 1)], unique=True)
+    await loyalty_cards_collection.create_index([("vendor_id", 1), ("_id", -1)])
\ No newline at end of file
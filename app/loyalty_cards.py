@@ -1,22 +1,50 @@
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, Field, TypeAdapter, field_validator
 from typing import Optional, List
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, Query, Path
 from bson import ObjectId
+from cachetools import TTLCache
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 from database import loyalty_cards_collection, customers_collection
 from auth import get_current_vendor
+from utils import utc_now
+import asyncio
+import logging
 
 
 router = APIRouter()
 
+BULK_PUNCH_LIMIT = 500
+
+logger = logging.getLogger(__name__)
+
+# Loyalty card documents keyed by _id, invalidated by watch_loyalty_cards
+CARD_CACHE_TTL = 300
+_card_cache = TTLCache(maxsize=50_000, ttl=CARD_CACHE_TTL)
+
+# Eviction sequence numbers, so a read that raced an eviction is not cached
+_card_eviction_seq = 0
+_card_cache_cleared_seq = 0
+_card_evictions = TTLCache(maxsize=50_000, ttl=60)  # card_id -> seq of latest eviction
+
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+CHANGE_STREAM_MAX_RETRY_DELAY = 60
+
 
 class LoyaltyCardCreateRequest(BaseModel):
     customer_id: str = Field(..., example="6510d3f5b12345abcd67890f")
     reward_threshold: int = Field(..., example=10)
 
 
+class LoyaltyCardBulkPunchRequest(BaseModel):
+    # Repeated IDs are punched once
+    card_ids: List[str] = Field(..., example=["6510d3f5b12345abcd67890f"])
+
+
 class LoyaltyCardResponse(BaseModel):
-    card_id: str
+    card_id: str = Field(..., validation_alias=AliasChoices("card_id", "_id"))
     vendor_id: str
     customer_id: str
     punches: int
@@ -25,84 +53,145 @@ class LoyaltyCardResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+    # Accept raw MongoDB documents, converting ObjectIds to strings
+    @field_validator("card_id", "vendor_id", "customer_id", mode="before")
+    @classmethod
+    def object_id_to_str(cls, value):
+        if isinstance(value, ObjectId):
+            return value.binary.hex()
+        return value
+
+
+loyalty_card_list_adapter = TypeAdapter(List[LoyaltyCardResponse])
+
+
+def _evict_card(card_id: ObjectId):
+    global _card_eviction_seq
+    _card_eviction_seq += 1
+    _card_evictions[card_id] = _card_eviction_seq
+    _card_cache.pop(card_id, None)
+
+
+def _clear_card_cache():
+    global _card_eviction_seq, _card_cache_cleared_seq
+    _card_eviction_seq += 1
+    _card_cache_cleared_seq = _card_eviction_seq
+    _card_cache.clear()
+
+
+def _fill_card_cache(card_id: ObjectId, card: dict, read_seq: int):
+    # Skip if the card was evicted while it was being read
+    if _card_cache_cleared_seq > read_seq or _card_evictions.get(card_id, 0) > read_seq:
+        return
+    _card_cache[card_id] = card
+
+
+async def watch_loyalty_cards():
+    # Drop cached cards as soon as MongoDB reports a change to them
+    resume_token = None
+    retry_delay = 1
+    while True:
+        try:
+            async with loyalty_cards_collection.watch(resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    retry_delay = 1
+                    document_key = change.get("documentKey")
+                    if document_key:
+                        _evict_card(document_key["_id"])
+                    else:
+                        _clear_card_cache()
+            # Stream closed (e.g. invalidated); start a fresh one
+            resume_token = None
+        except OperationFailure as exc:
+            if exc.code == CHANGE_STREAM_NOT_SUPPORTED:
+                # Change streams need a replica set; cached cards then expire by TTL only
+                _clear_card_cache()
+                logger.warning("Loyalty card change stream unavailable, using TTL-only cache: %s", exc)
+                return
+            if exc.code == CHANGE_STREAM_HISTORY_LOST:
+                resume_token = None
+            logger.warning("Loyalty card change stream failed, retrying in %ss: %s", retry_delay, exc)
+        except PyMongoError as exc:
+            logger.warning("Loyalty card change stream failed, retrying in %ss: %s", retry_delay, exc)
+
+        # Changes may have been missed while the stream was down
+        _clear_card_cache()
+        await asyncio.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, CHANGE_STREAM_MAX_RETRY_DELAY)
+
 
 @router.post('/')
 async def create_loyalty_card(card: LoyaltyCardCreateRequest, current_vendor: dict = Depends(get_current_vendor)):
-    try:
-        cust_obj_id = ObjectId(card.customer_id)
-    except:
-        raise HTTPException(status_code=400, description="Invalid customer ID format")
+    if not ObjectId.is_valid(card.customer_id):
+        raise HTTPException(status_code=400, detail="Invalid customer ID format")
+    cust_obj_id = ObjectId(card.customer_id)
     
-    customer = customers_collection.find_one({"_id":cust_obj_id})
+    customer = await customers_collection.find_one({"_id": cust_obj_id, "vendor_id": current_vendor["_id"]}, projection={"_id": 1})
     if not customer:
-        raise HTTPException(status_code=404, description = "Customer not found")
-    
-    exist_card = loyalty_cards_collection.find_one({"customer_id":cust_obj_id, "vendor_id":current_vendor["_id"]})
-    if exist_card is not None:
-        raise HTTPException(status_code=400, description="Card already exist")
+        raise HTTPException(status_code=404, detail="Customer not found")
     
+    now = utc_now()
     new_card = {
         "vendor_id": current_vendor["_id"],
         "customer_id": cust_obj_id,
         "punches": 0,
         "reward_threshold": card.reward_threshold,
         "reward_claimed": False,
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
+        "created_at": now,
+        "updated_at": now
     }
 
-    result = loyalty_cards_collection.insert_one(new_card)
+    # Unique (vendor_id, customer_id) index rejects a second card
+    try:
+        result = await loyalty_cards_collection.insert_one(new_card)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Card already exist")
     new_card["_id"] = result.inserted_id
 
-    return LoyaltyCardResponse(
-        card_id=str(new_card["_id"]),
-        vendor_id=str(new_card["vendor_id"]),
-        customer_id=str(new_card["customer_id"]),
-        punches=new_card["punches"],
-        reward_threshold=new_card["reward_threshold"],
-        reward_claimed=new_card["reward_claimed"],
-        created_at=new_card["created_at"],
-        updated_at=new_card["updated_at"]
-    )
+    return LoyaltyCardResponse.model_validate(new_card)
 
 
 @router.get("/{card_id}")
 async def get_loyalty_card(card_id: str, current_vendor: dict = Depends(get_current_vendor)):
     # Convert ID
-    try:
-        card_obj_id = ObjectId(card_id)
-    except:
+    if not ObjectId.is_valid(card_id):
         raise HTTPException(status_code=400, detail="Invalid loyalty card ID format")
-
-    # Find loyalty card
-    card = loyalty_cards_collection.find_one({"_id": card_obj_id})
+    card_obj_id = ObjectId(card_id)
+
+    # Serve from cache when possible; a card's vendor never changes
+    card = _card_cache.get(card_obj_id)
+    if card is not None:
+        if card["vendor_id"] != current_vendor["_id"]:
+            raise HTTPException(status_code=403, detail="Not authorized to access this loyalty card")
+        return LoyaltyCardResponse.model_validate(card)
+
+    # Find loyalty card owned by this vendor
+    read_seq = _card_eviction_seq
+    card = await loyalty_cards_collection.find_one({"_id": card_obj_id, "vendor_id": current_vendor["_id"]})
     if not card:
+        # Distinguish a missing card from one owned by another vendor
+        if await loyalty_cards_collection.count_documents({"_id": card_obj_id}, limit=1):
+            raise HTTPException(status_code=403, detail="Not authorized to access this loyalty card")
         raise HTTPException(status_code=404, detail="Loyalty card not found")
 
-    # Vendor ownership check
-    if card["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to access this loyalty card")
-
-    return LoyaltyCardResponse(
-        card_id=str(card["_id"]),
-        vendor_id=str(card["vendor_id"]),
-        customer_id=str(card["customer_id"]),
-        punches=card["punches"],
-        reward_threshold=card["reward_threshold"],
-        reward_claimed=card["reward_claimed"],
-        created_at=card["created_at"],
-        updated_at=card["updated_at"]
-    )
+    _fill_card_cache(card_obj_id, card, read_seq)
+
+    return LoyaltyCardResponse.model_validate(card)
 
 
 @router.get("/")
-async def list_loyalty_cards(vendor_id: Optional[str] = Query(None, description="Filter by vendor_id"), current_vendor: dict = Depends(get_current_vendor)):
+async def list_loyalty_cards(
+    vendor_id: Optional[str] = Query(None, description="Filter by vendor_id"),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of cards to return"),
+    after: Optional[str] = Query(None, description="Return cards after this card_id"),
+    current_vendor: dict = Depends(get_current_vendor)
+):
     # If vendor_id provided, validate and enforce ownership
     if vendor_id:
-        try:
-            vendor_obj_id = ObjectId(vendor_id)
-        except:
+        if not ObjectId.is_valid(vendor_id):
             raise HTTPException(status_code=400, detail="Invalid vendor_id format")
+        vendor_obj_id = ObjectId(vendor_id)
 
         if vendor_obj_id != current_vendor["_id"]:
             raise HTTPException(status_code=403, detail="Not authorized to view this vendor's cards")
@@ -112,74 +201,94 @@ async def list_loyalty_cards(vendor_id: Optional[str] = Query(None, description=
         # Default to current vendor
         query = {"vendor_id": current_vendor["_id"]}
 
-    # Fetch cards
-    cards_cursor = loyalty_cards_collection.find(query).sort("created_at", -1)
+    # Keyset pagination on _id, newest first
+    if after:
+        if not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail="Invalid loyalty card ID format")
+        query["_id"] = {"$lt": ObjectId(after)}
+
+    # Fetch a page of cards
+    cards_cursor = loyalty_cards_collection.find(query).sort("_id", -1).limit(limit)
     
-    cards = [
-        LoyaltyCardResponse(
-            card_id=str(card["_id"]),
-            vendor_id=str(card["vendor_id"]),
-            customer_id=str(card["customer_id"]),
-            punches=card["punches"],
-            reward_threshold=card["reward_threshold"],
-            reward_claimed=card["reward_claimed"],
-            created_at=card["created_at"],
-            updated_at=card["updated_at"]
+    return loyalty_card_list_adapter.validate_python(await cards_cursor.to_list(length=limit))
+
+
+@router.put("/punch")
+async def bulk_punch_loyalty_cards(punches: LoyaltyCardBulkPunchRequest, current_vendor: dict = Depends(get_current_vendor)):
+    if not punches.card_ids:
+        raise HTTPException(status_code=400, detail="No loyalty cards to punch")
+
+    if len(punches.card_ids) > BULK_PUNCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Cannot punch more than {BULK_PUNCH_LIMIT} loyalty cards at once")
+
+    # Validate card_ids
+    for card_id in punches.card_ids:
+        if not ObjectId.is_valid(card_id):
+            raise HTTPException(status_code=400, detail=f"Invalid loyalty card ID format: {card_id}")
+
+    # De-duplicate, keeping request order
+    card_obj_ids = list(dict.fromkeys(ObjectId(card_id) for card_id in punches.card_ids))
+
+    # Punch every owned, unclaimed card in one unordered batch
+    updated_at = utc_now()
+    result = await loyalty_cards_collection.bulk_write(
+        [
+            UpdateOne(
+                {"_id": card_obj_id, "vendor_id": current_vendor["_id"], "reward_claimed": False},
+                {"$inc": {"punches": 1}, "$set": {"updated_at": updated_at}}
+            )
+            for card_obj_id in card_obj_ids
+        ],
+        ordered=False
+    )
+
+    for card_obj_id in card_obj_ids:
+        _evict_card(card_obj_id)
+
+    # Only look up which cards were skipped (missing, not owned or already claimed) when some were
+    skipped = []
+    if result.modified_count < len(card_obj_ids):
+        punched_cursor = loyalty_cards_collection.find(
+            {"_id": {"$in": card_obj_ids}, "vendor_id": current_vendor["_id"], "reward_claimed": False},
+            projection={"_id": 1}
         )
-        for card in cards_cursor
-    ]
+        punched_ids = {card["_id"] for card in await punched_cursor.to_list(length=None)}
+        skipped = [card_obj_id.binary.hex() for card_obj_id in card_obj_ids if card_obj_id not in punched_ids]
 
-    return cards
+    return {"requested": len(card_obj_ids), "punched": result.modified_count, "skipped": skipped}
 
 
 @router.put("/{card_id}/punch")
 async def punch_loyalty_card(card_id: str = Path(..., description="Loyalty card ID"), current_vendor: dict = Depends(get_current_vendor)):
     # Validate card_id
-    try:
-        card_obj_id = ObjectId(card_id)
-    except:
+    if not ObjectId.is_valid(card_id):
         raise HTTPException(status_code=400, detail="Invalid loyalty card ID format")
+    card_obj_id = ObjectId(card_id)
 
-    # Find card
-    card = loyalty_cards_collection.find_one({"_id": card_obj_id})
-    if not card:
-        raise HTTPException(status_code=404, detail="Loyalty card not found")
+    # Ownership check, claimed check and increment in a single atomic update
+    updated_card = await loyalty_cards_collection.find_one_and_update(
+        {"_id": card_obj_id, "vendor_id": current_vendor["_id"], "reward_claimed": False},
+        {
+            "$inc": {"punches": 1},
+            "$set": {"updated_at": utc_now()}
+        },
+        return_document=ReturnDocument.AFTER
+    )
 
-    # Ownership check
-    if card["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to punch this card")
+    if not updated_card:
+        # Re-query only to report why the update did not match
+        card = await loyalty_cards_collection.find_one({"_id": card_obj_id})
+        if not card:
+            raise HTTPException(status_code=404, detail="Loyalty card not found")
 
-    # If reward already claimed, block further punches
-    if card.get("reward_claimed", False):
-        raise HTTPException(status_code=400, detail="Reward already claimed, cannot add more punches")
+        if card["vendor_id"] != current_vendor["_id"]:
+            raise HTTPException(status_code=403, detail="Not authorized to punch this card")
 
-    # Increment punches
-    new_punches = card["punches"] + 1
+        raise HTTPException(status_code=400, detail="Reward already claimed, cannot add more punches")
 
-    # Update document
-    loyalty_cards_collection.update_one(
-        {"_id": card_obj_id},
-        {
-            "$set": {
-                "punches": new_punches,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    _evict_card(card_obj_id)
 
-    # Fetch updated card
-    updated_card = loyalty_cards_collection.find_one({"_id": card_obj_id})
-
-    return LoyaltyCardResponse(
-        card_id=str(updated_card["_id"]),
-        vendor_id=str(updated_card["vendor_id"]),
-        customer_id=str(updated_card["customer_id"]),
-        punches=updated_card["punches"],
-        reward_threshold=updated_card["reward_threshold"],
-        reward_claimed=updated_card["reward_claimed"],
-        created_at=updated_card["created_at"],
-        updated_at=updated_card["updated_at"]
-    )
+    return LoyaltyCardResponse.model_validate(updated_card)
 
 
 @router.put("/{card_id}/redeem", response_model=LoyaltyCardResponse)
@@ -188,44 +297,36 @@ async def redeem_loyalty_card(
     current_vendor: dict = Depends(get_current_vendor)
 ):
     # Validate card_id
-    try:
-        card_obj_id = ObjectId(card_id)
-    except:
+    if not ObjectId.is_valid(card_id):
         raise HTTPException(status_code=400, detail="Invalid loyalty card ID format")
+    card_obj_id = ObjectId(card_id)
 
-    # Find loyalty card
-    card = loyalty_cards_collection.find_one({"_id": card_obj_id})
-    if not card:
-        raise HTTPException(status_code=404, detail="Loyalty card not found")
+    # Ownership, claimed and threshold checks plus update in a single query
+    updated_card = await loyalty_cards_collection.find_one_and_update(
+        {
+            "_id": card_obj_id,
+            "vendor_id": current_vendor["_id"],
+            "reward_claimed": False,
+            "$expr": {"$gte": ["$punches", "$reward_threshold"]}
+        },
+        {"$set": {"reward_claimed": True, "updated_at": utc_now()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+    if not updated_card:
+        # Re-query only to report why the update did not match
+        card = await loyalty_cards_collection.find_one({"_id": card_obj_id})
+        if not card:
+            raise HTTPException(status_code=404, detail="Loyalty card not found")
 
-    # Vendor ownership check
-    if card["vendor_id"] != current_vendor["_id"]:
-        raise HTTPException(status_code=403, detail="Not authorized to redeem this card")
+        if card["vendor_id"] != current_vendor["_id"]:
+            raise HTTPException(status_code=403, detail="Not authorized to redeem this card")
 
-    # Already redeemed check
-    if card.get("reward_claimed", False):
-        raise HTTPException(status_code=400, detail="Reward already claimed for this card")
+        if card.get("reward_claimed", False):
+            raise HTTPException(status_code=400, detail="Reward already claimed for this card")
 
-    # Check punches threshold
-    if card["punches"] < card["reward_threshold"]:
         raise HTTPException(status_code=400, detail="Not enough punches to redeem reward")
 
-    # Update reward status
-    loyalty_cards_collection.update_one(
-        {"_id": card_obj_id},
-        {"$set": {"reward_claimed": True, "updated_at": datetime.utcnow()}}
-    )
+    _evict_card(card_obj_id)
 
-    # Fetch updated card
-    updated_card = loyalty_cards_collection.find_one({"_id": card_obj_id})
-
-    return LoyaltyCardResponse(
-        card_id=str(updated_card["_id"]),
-        vendor_id=str(updated_card["vendor_id"]),
-        customer_id=str(updated_card["customer_id"]),
-        punches=updated_card["punches"],
-        reward_threshold=updated_card["reward_threshold"],
-        reward_claimed=updated_card["reward_claimed"],
-        created_at=updated_card["created_at"],
-        updated_at=updated_card["updated_at"]
-    )
\ No newline at end of file
+    return LoyaltyCardResponse.model_validate(updated_card)
\ No newline at end of file
@@ -1,9 +1,41 @@
 from fastapi import FastAPI
-from auth import router as auth_router
+from fastapi.responses import ORJSONResponse
+from database import create_indexes
+from storage import open_storage, close_storage
+from auth import router as auth_router, start_password_pool, stop_password_pool
 from customers import router as customer_router
-from loyalty_cards import router as loyalty_card_router
+from loyalty_cards import router as loyalty_card_router, watch_loyalty_cards
+import asyncio
+
+
+app = FastAPI(title="Digital Loyalty Card API", default_response_class=ORJSONResponse)
+
+background_tasks = set()
+
+
+@app.on_event("startup")
+async def startup():
+    # Ensure MongoDB indexes exist once per process
+    await create_indexes()
+
+    # Open the shared S3 client used for QR codes
+    await open_storage()
+
+    # Start the password hashing process pool, if enabled
+    start_password_pool()
+
+    # Invalidate cached loyalty cards from the MongoDB change stream
+    background_tasks.add(asyncio.create_task(watch_loyalty_cards()))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+
+    stop_password_pool()
+    await close_storage()
 
-app = FastAPI(title="Digital Loyalty Card API")
 
 # Include auth routes
 app.include_router(auth_router, prefix="/auth", tags=["Auth"])
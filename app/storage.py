@@ -0,0 +1,65 @@
+from botocore.exceptions import ClientError
+from contextlib import AsyncExitStack
+from typing import Optional
+import aioboto3
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+S3_BUCKET = os.getenv("S3_BUCKET", "digital-loyalty-card")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Set for MinIO / other S3-compatible stores
+QR_PUBLIC_BASE_URL = os.getenv("QR_PUBLIC_BASE_URL")  # CDN or public bucket URL, if any
+QR_URL_EXPIRE_SECONDS = int(os.getenv("QR_URL_EXPIRE_SECONDS", 3600))
+
+session = aioboto3.Session()
+
+# Shared S3 client, opened on app startup and closed on shutdown
+_exit_stack = AsyncExitStack()
+s3 = None
+
+
+async def open_storage():
+    global s3
+    s3 = await _exit_stack.enter_async_context(session.client("s3", endpoint_url=S3_ENDPOINT_URL))
+
+
+async def close_storage():
+    global s3
+    await _exit_stack.aclose()
+    s3 = None
+
+
+def qr_key(customer_id: str) -> str:
+    return f"qr/{customer_id}.png"
+
+
+def qr_url(customer_id: str) -> str:
+    # URL stored on the customer document; without a public URL, the API route redirects to S3
+    if QR_PUBLIC_BASE_URL:
+        return f"{QR_PUBLIC_BASE_URL.rstrip('/')}/{qr_key(customer_id)}"
+    return f"/customer/{customer_id}/qr"
+
+
+async def upload_qr(customer_id: str, png_bytes: bytes):
+    await s3.put_object(Bucket=S3_BUCKET, Key=qr_key(customer_id), Body=png_bytes, ContentType="image/png")
+
+
+async def delete_qr(customer_id: str):
+    await s3.delete_object(Bucket=S3_BUCKET, Key=qr_key(customer_id))
+
+
+async def presign_qr(customer_id: str) -> Optional[str]:
+    # None when no QR code is stored, e.g. customers from before QR codes moved to S3
+    try:
+        await s3.head_object(Bucket=S3_BUCKET, Key=qr_key(customer_id))
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+    return await s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": S3_BUCKET, "Key": qr_key(customer_id)},
+        ExpiresIn=QR_URL_EXPIRE_SECONDS
+    )
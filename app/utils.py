@@ -0,0 +1,23 @@
+from datetime import datetime, timezone
+import io
+import qrcode
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def render_qr(content: str) -> bytes:
+    # Smallest version / lowest error correction that fits, rendered to PNG in memory
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=4,
+        border=2
+    )
+    qr.add_data(content)
+    qr.make(fit=True)
+
+    buf = io.BytesIO()
+    qr.make_image().save(buf)
+    return buf.getvalue()